@@ -23,7 +23,7 @@ from scipy.spatial.distance import cdist
 
 from ._fiff.constants import FIFF
 from ._fiff.pick import pick_types
-from .fixes import bincount, jit, prange
+from .fixes import bincount, has_numba, jit, prange
 from .parallel import parallel_func
 from .transforms import (
     Transform,
@@ -616,7 +616,7 @@ class _CDist:
         return np.array(dists), np.array(nearest)
 
 
-def _compute_nearest(xhs, rr, method="BallTree", return_dists=False):
+def _compute_nearest(xhs, rr, method="auto", return_dists=False):
     """Find nearest neighbors.
 
     Parameters
@@ -626,8 +626,11 @@ def _compute_nearest(xhs, rr, method="BallTree", return_dists=False):
     rr : array, shape=(n_query, n_dim)
         Points to find nearest neighbors for.
     method : str
-        The query method. If scikit-learn and scipy<1.0 are installed,
-        it will fall back to the slow brute-force search.
+        The query method, "auto", "brute", "BallTree", "KDTree", or "cdist".
+        "auto" uses the (numba) "brute" search of 3D points for just a few
+        queries when numba is available, and "BallTree" otherwise.
+        If scikit-learn and scipy<1.0 are installed, "BallTree" will fall back
+        to the slow brute-force search.
     return_dists : bool
         If True, return associated distances.
 
@@ -642,11 +645,39 @@ def _compute_nearest(xhs, rr, method="BallTree", return_dists=False):
         if return_dists:
             return np.array([], int), np.array([])
         return np.array([], int)
-    tree = _DistanceQuery(xhs, method=method)
-    out = tree.query(rr)
+    if method == "auto":
+        # for just a few queries, building a tree costs more than brute force
+        few = xhs.shape[1] == rr.shape[1] == 3 and len(rr) <= np.log2(len(xhs))
+        method = "brute" if has_numba and few else "BallTree"
+    if method == "brute":
+        out = _nearest_brute(
+            np.asarray(xhs, dtype=np.float64), np.asarray(rr, dtype=np.float64)
+        )
+    else:
+        tree = _DistanceQuery(xhs, method=method)
+        out = tree.query(rr)
     return out[::-1] if return_dists else out[1]
 
 
+@jit()
+def _nearest_brute(xhs, rr):
+    """Find nearest neighbors of 3D points by exhaustive search."""
+    dists = np.empty(rr.shape[0])
+    nearest = np.empty(rr.shape[0], np.int64)
+    for qi in range(rr.shape[0]):
+        best, best_idx = np.inf, 0
+        for pi in range(xhs.shape[0]):
+            dx = xhs[pi, 0] - rr[qi, 0]
+            dy = xhs[pi, 1] - rr[qi, 1]
+            dz = xhs[pi, 2] - rr[qi, 2]
+            d = dx * dx + dy * dy + dz * dz
+            if d < best:
+                best, best_idx = d, pi
+        dists[qi] = np.sqrt(best)
+        nearest[qi] = best_idx
+    return dists, nearest
+
+
 def _safe_query(rr, func, reduce=False, **kwargs):
     if len(rr) == 0:
         return np.array([]), np.array([], int)
@@ -3,8 +3,8 @@
 # Copyright the MNE-Python contributors.
 
 import os
+import shutil
 
-import matplotlib.pyplot as plt
 import numpy as np
 import pytest
 from numpy.testing import assert_allclose, assert_array_equal, assert_array_less
@@ -42,7 +42,7 @@ from mne.proj import make_eeg_average_ref_proj
 from mne.simulation import simulate_evoked
 from mne.surface import _compute_nearest
 from mne.transforms import _get_trans, apply_trans
-from mne.utils import _record_warnings, requires_mne, run_subprocess
+from mne.utils import _record_warnings, has_mne_c, object_hash, run_subprocess
 
 data_path = testing.data_path(download=False)
 meg_path = data_path / "MEG" / "sample"
@@ -68,6 +68,38 @@ fname_ctf = data_path / "CTF" / "testdata_ctf_short.ds"
 subjects_dir = data_path / "subjects"
 
 
+# Scoping these as module will make things faster, but need to make sure
+# not to modify them in-place in the tests, so keep them private
+@pytest.fixture(scope="module", params=[testing._pytest_param()])
+def _dip_sample():
+    """Read the sample dipole file."""
+    return read_dipole(fname_dip)
+
+
+@pytest.fixture(scope="module", params=[testing._pytest_param()])
+def _evoked_sample():
+    """Read the sample evoked data."""
+    return read_evokeds(fname_evo)[0]
+
+
+@pytest.fixture(scope="module", params=[testing._pytest_param()])
+def _cov_sample():
+    """Read the sample noise covariance."""
+    return read_cov(fname_cov)
+
+
+@pytest.fixture(scope="module", params=[testing._pytest_param()])
+def _bem_solution():
+    """Read the sample BEM solution."""
+    return read_bem_solution(fname_bem)
+
+
+@pytest.fixture(scope="session", params=[testing._pytest_param()])
+def _raw_ctf():
+    """Read the short CTF recording with an average EEG reference projector."""
+    return read_raw_ctf(fname_ctf, preload=False).set_eeg_reference(projection=True)
+
+
 def _compare_dipoles(orig, new):
     """Compare dipole results for equivalence."""
     assert_allclose(orig.times, new.times, atol=1e-3, err_msg="times")
@@ -87,10 +119,19 @@ def _check_dipole(dip, n_dipoles):
     assert dip.amplitude.shape == (n_dipoles,)
 
 
+def _pearson(a, b):
+    """Compute the Pearson correlation of two 1D arrays."""
+    a = a - a.mean()
+    b = b - b.mean()
+    return np.einsum("i,i->", a, b) / np.sqrt(
+        np.einsum("i,i->", a, a) * np.einsum("i,i->", b, b)
+    )
+
+
 @testing.requires_testing_data
-def test_io_dipoles(tmp_path):
+def test_io_dipoles(_dip_sample, tmp_path):
     """Test IO for .dip files."""
-    dipole = read_dipole(fname_dip)
+    dipole = _dip_sample.copy()
     assert "Dipole " in repr(dipole)  # test repr
     out_fname = tmp_path / "temp.dip"
     dipole.save(out_fname)
@@ -99,10 +140,10 @@ def test_io_dipoles(tmp_path):
 
 
 @testing.requires_testing_data
-def test_dipole_fitting_ctf():
+def test_dipole_fitting_ctf(_raw_ctf):
     """Test dipole fitting with CTF data."""
     pytest.importorskip("nibabel")
-    raw_ctf = read_raw_ctf(fname_ctf).set_eeg_reference(projection=True)
+    raw_ctf = _raw_ctf
     events = make_fixed_length_events(raw_ctf, 1)
     evoked = Epochs(raw_ctf, events, 1, 0, 0, baseline=None).average()
     cov = make_ad_hoc_cov(evoked.info)
@@ -123,8 +164,7 @@ def test_dipole_fitting_ctf():
 
 @pytest.mark.slowtest
 @testing.requires_testing_data
-@requires_mne
-def test_dipole_fitting(tmp_path):
+def test_dipole_fitting(_evoked_sample, _cov_sample, tmp_path, request):
     """Test dipole fitting."""
     pytest.importorskip("nibabel")
     amp = 100e-9
@@ -134,14 +174,16 @@ def test_dipole_fitting(tmp_path):
     fwd = convert_forward_solution(
         read_forward_solution(fname_fwd), surf_ori=False, force_fixed=True, use_cps=True
     )
-    evoked = read_evokeds(fname_evo)[0]
-    cov = read_cov(fname_cov)
+    cov = _cov_sample.copy()
     n_per_hemi = 5
     vertices = [np.sort(rng.permutation(s["vertno"])[:n_per_hemi]) for s in fwd["src"]]
     nv = sum(len(v) for v in vertices)
     stc = SourceEstimate(amp * np.eye(nv), vertices, 0, 0.001)
+    # Simulate on all channels (rather than only the subset used below) to keep
+    # the seeded noise realization that target_labels and the thresholds
+    # below were tuned for
     evoked = simulate_evoked(
-        fwd, stc, evoked.info, cov, nave=evoked.nave, random_state=rng
+        fwd, stc, _evoked_sample.info, cov, nave=_evoked_sample.nave, random_state=rng
     )
     # For speed, let's use a subset of channels (strange but works)
     picks = np.sort(
@@ -154,29 +196,53 @@ def test_dipole_fitting(tmp_path):
     )
     evoked.pick([evoked.ch_names[p] for p in picks])
     evoked.add_proj(make_eeg_average_ref_proj(evoked.info))
-    write_evokeds(fname_sim, evoked)
-
-    # Run MNE-C version
-    run_subprocess(
-        [
-            "mne_dipole_fit",
-            "--meas",
-            fname_sim,
-            "--meg",
-            "--eeg",
-            "--noise",
-            fname_cov,
-            "--dip",
-            fname_dtemp,
-            "--mri",
-            fname_fwd,
-            "--reg",
-            "0",
-            "--tmin",
-            "0",
-        ]
+
+    # Run MNE-C version only if needed: its output is cached in the pytest
+    # cache, keyed on everything it is given (set MNE_REGENERATE_C_REF=true
+    # or 1 to force regeneration)
+    c_ref_key = object_hash(
+        dict(
+            data=evoked.data,
+            ch_names=evoked.ch_names,
+            times=evoked.times,
+            nave=evoked.nave,
+            projs=[proj["data"]["data"] for proj in evoked.info["projs"]],
+            cov=fname_cov.name,
+            fwd=fname_fwd.name,
+        )
     )
-    dip_c = read_dipole(fname_dtemp)
+    cache = getattr(request.config, "cache", None)  # None w/-p no:cacheprovider
+    c_ref_dir = tmp_path if cache is None else cache.mkdir("mne_dipole_fit")
+    fname_dip_c_ref = c_ref_dir / f"sample_trunc_c_reference_{c_ref_key:032x}.dip"
+    regenerate = os.getenv("MNE_REGENERATE_C_REF", "false").lower() in ("true", "1")
+    if regenerate or not fname_dip_c_ref.is_file():
+        if not has_mne_c():
+            pytest.skip("Requires MNE-C to generate the reference dipoles")
+        write_evokeds(fname_sim, evoked)
+        run_subprocess(
+            [
+                "mne_dipole_fit",
+                "--meas",
+                fname_sim,
+                "--meg",
+                "--eeg",
+                "--noise",
+                fname_cov,
+                "--dip",
+                fname_dtemp,
+                "--mri",
+                fname_fwd,
+                "--reg",
+                "0",
+                "--tmin",
+                "0",
+            ]
+        )
+        # copy next to the reference then rename, so it appears atomically
+        fname_tmp = fname_dip_c_ref.with_name(f"{fname_dip_c_ref.name}.{os.getpid()}")
+        shutil.copyfile(fname_dtemp, fname_tmp)
+        os.replace(fname_tmp, fname_dip_c_ref)
+    dip_c = read_dipole(fname_dip_c_ref)
 
     # Run mne-python version
     sphere = make_sphere_model(head_radius=0.1)
@@ -212,18 +278,23 @@ def test_dipole_fitting(tmp_path):
     assert labels == target_labels
 
     # Sanity check: do our residuals have less power than orig data?
-    data_rms = np.sqrt(np.sum(evoked.data**2, axis=0))
-    resi_rms = np.sqrt(np.sum(residual.data**2, axis=0))
-    assert (data_rms > resi_rms * 0.95).all(), (
-        f"{(data_rms / resi_rms).min()} (factor: {0.95})"
+    # (compare sums of squares to avoid temporaries and square roots)
+    data_ss = np.einsum("ij,ij->j", evoked.data, evoked.data)
+    resi_ss = np.einsum("ij,ij->j", residual.data, residual.data)
+    assert (data_ss > resi_ss * 0.95**2).all(), (
+        f"{np.sqrt((data_ss / resi_ss).min())} (factor: {0.95})"
     )
 
     # Compare to original points
-    transform_surface_to(fwd["src"][0], "head", fwd["mri_head_t"])
-    transform_surface_to(fwd["src"][1], "head", fwd["mri_head_t"])
-    assert fwd["src"][0]["coord_frame"] == FIFF.FIFFV_COORD_HEAD
-    src_rr = np.concatenate([s["rr"][v] for s, v in zip(fwd["src"], vertices)], axis=0)
-    src_nn = np.concatenate([s["nn"][v] for s, v in zip(fwd["src"], vertices)], axis=0)
+    src_rr, src_nn = np.empty((nv, 3)), np.empty((nv, 3))
+    off = 0
+    for s, v in zip(fwd["src"], vertices):
+        transform_surface_to(s, "head", fwd["mri_head_t"])
+        assert s["coord_frame"] == FIFF.FIFFV_COORD_HEAD
+        src_rr[off : off + len(v)] = s["rr"][v]
+        src_nn[off : off + len(v)] = s["nn"][v]
+        off += len(v)
+    assert off == nv
 
     # MNE-C skips the last "time" point :(
     out = dip.crop(dip_c.times[0], dip_c.times[-1])
@@ -231,15 +302,18 @@ def test_dipole_fitting(tmp_path):
     src_rr, src_nn = src_rr[:-1], src_nn[:-1]
 
     # check that we did about as well
-    corrs, dists, gc_dists, amp_errs, gofs = [], [], [], [], []
-    for d in (dip_c, dip):
-        new = d.pos
-        diffs = new - src_rr
-        corrs += [np.corrcoef(src_rr.ravel(), new.ravel())[0, 1]]
-        dists += [np.sqrt(np.mean(np.sum(diffs * diffs, axis=1)))]
-        gc_dists += [180 / np.pi * np.mean(np.arccos(np.sum(src_nn * d.ori, axis=1)))]
-        amp_errs += [np.sqrt(np.mean((amp - d.amplitude) ** 2))]
-        gofs += [np.mean(d.gof)]
+    # (metrics for both fits are computed at once, MNE-C first)
+    poss = np.stack([dip_c.pos, dip.pos])
+    oris = np.stack([dip_c.ori, dip.ori])
+    amps = np.stack([dip_c.amplitude, dip.amplitude])
+    gofs_all = np.stack([dip_c.gof, dip.gof])
+    diffs = poss - src_rr[np.newaxis]
+    corrs = [_pearson(src_rr.ravel(), new.ravel()) for new in poss]
+    dists = np.sqrt(np.mean(np.einsum("kij,kij->ki", diffs, diffs), axis=1))
+    gc_dists = 180 / np.pi * np.arccos(np.einsum("ij,kij->ki", src_nn, oris))
+    gc_dists = gc_dists.mean(axis=1)
+    amp_errs = np.sqrt(np.mean((amp - amps) ** 2, axis=1))
+    gofs = gofs_all.mean(axis=1)
     # XXX possibly some OpenBLAS numerical differences make
     # things slightly worse for us
     factor = 0.7
@@ -252,16 +326,19 @@ def test_dipole_fitting(tmp_path):
 
 
 @testing.requires_testing_data
-def test_dipole_fitting_fixed(tmp_path):
+def test_dipole_fitting_fixed(_evoked_sample, _cov_sample, tmp_path):
     """Test dipole fitting with a fixed position."""
     tpeak = 0.073
     sphere = make_sphere_model(head_radius=0.1)
-    evoked = read_evokeds(fname_evo, baseline=(None, 0))[0]
+    evoked = _evoked_sample.copy().apply_baseline((None, 0))
     evoked.pick("meg")
     t_idx = np.argmin(np.abs(tpeak - evoked.times))
-    evoked_crop = evoked.copy().crop(tpeak, tpeak)
+    # single-sample evokeds built directly from a slice avoid copying all data
+    evoked_crop = EvokedArray(
+        evoked.data[:, [t_idx]], evoked.info, evoked.times[t_idx], nave=evoked.nave
+    )
     assert len(evoked_crop.times) == 1
-    cov = read_cov(fname_cov)
+    cov = _cov_sample.copy()
     dip_seq, resid = fit_dipole(evoked_crop, cov, sphere)
     assert isinstance(dip_seq, Dipole)
     assert isinstance(resid, Evoked)
@@ -273,7 +350,7 @@ def test_dipole_fitting_fixed(tmp_path):
     assert isinstance(dip_free, Dipole)
     assert isinstance(resid_free, Evoked)
     assert_allclose(dip_free.times, evoked.times)
-    assert_allclose(np.tile(pos[np.newaxis], (len(evoked.times), 1)), dip_free.pos)
+    assert_allclose(np.broadcast_to(pos, (len(evoked.times), 3)), dip_free.pos)
     assert_allclose(ori, dip_free.ori[t_idx])  # should find same ori
     assert np.dot(dip_free.ori, ori).mean() < 0.9  # but few the same
     assert_allclose(gof, dip_free.gof[t_idx])  # ... same gof
@@ -292,7 +369,10 @@ def test_dipole_fitting_fixed(tmp_path):
     evoked.info["bads"] = [evoked.ch_names[3]]
     dip_fixed, resid_fixed = fit_dipole(evoked, cov, sphere, pos=pos, ori=ori)
     # Degenerate conditions
-    evoked_nan = evoked.copy().crop(0, 0)
+    t0_idx = np.argmin(np.abs(evoked.times))
+    evoked_nan = EvokedArray(
+        evoked.data[:, [t0_idx]], evoked.info, evoked.times[t0_idx], nave=evoked.nave
+    )
     evoked_nan.data[0, 0] = None
     pytest.raises(ValueError, fit_dipole, evoked_nan, cov, sphere)
     pytest.raises(ValueError, fit_dipole, evoked, cov, sphere, ori=[1, 0, 0])
@@ -305,6 +385,8 @@ def test_dipole_fitting_fixed(tmp_path):
     dip_fixed_2.data[:] = 0.0
     assert not np.isclose(dip_fixed.data, 0.0, atol=1e-20).any()
     # plotting
+    import matplotlib.pyplot as plt
+
     plt.close("all")
     dip_fixed.plot()
     plt.close("all")
@@ -314,9 +396,9 @@ def test_dipole_fitting_fixed(tmp_path):
 
 
 @testing.requires_testing_data
-def test_len_index_dipoles():
+def test_len_index_dipoles(_dip_sample):
     """Test len and indexing of Dipole objects."""
-    dipole = read_dipole(fname_dip)
+    dipole = _dip_sample.copy()
     d0 = dipole[0]
     d1 = dipole[:1]
     _check_dipole(d0, 1)
@@ -331,7 +413,7 @@ def test_len_index_dipoles():
 
 @pytest.mark.slowtest  # slow-ish on Travis OSX
 @testing.requires_testing_data
-def test_min_distance_fit_dipole():
+def test_min_distance_fit_dipole(_cov_sample, _bem_solution):
     """Test dipole min_dist to inner_skull."""
     subject = "sample"
     raw = read_raw_fif(fname_raw, preload=True)
@@ -341,7 +423,7 @@ def test_min_distance_fit_dipole():
     info = pick_info(raw.info, picks)
 
     # Let's use cov = Identity
-    cov = read_cov(fname_cov)
+    cov = _cov_sample.copy()
     cov["data"] = np.eye(cov["data"].shape[0])
 
     # Simulated scal map
@@ -354,25 +436,25 @@ def test_min_distance_fit_dipole():
 
     min_dist = 5.0  # distance in mm
 
-    bem = read_bem_solution(fname_bem)
+    bem = _bem_solution  # only read, fit_dipole makes its own copy
     dip, residual = fit_dipole(
         evoked, cov, bem, fname_trans, min_dist=min_dist, tol=1e-4
     )
     assert isinstance(residual, Evoked)
 
-    dist = _compute_depth(dip, fname_bem, fname_trans, subject, subjects_dir)
+    dist = _compute_depth(dip, bem, fname_trans, subject, subjects_dir)
 
     # Constraints are not exact, so bump the minimum slightly
     assert min_dist - 0.1 < (dist[0] * 1000.0) < (min_dist + 1.0)
 
+    # (min_dist is validated before the BEM is set up, so this never loads it)
     with pytest.raises(ValueError, match="min_dist should be positive"):
-        fit_dipole(evoked, cov, fname_bem, fname_trans, -1.0)
+        fit_dipole(evoked, cov, bem, fname_trans, -1.0)
 
 
-def _compute_depth(dip, fname_bem, fname_trans, subject, subjects_dir):
+def _compute_depth(dip, bem, fname_trans, subject, subjects_dir):
     """Compute dipole depth."""
     trans = _get_trans(fname_trans)[0]
-    bem = read_bem_solution(fname_bem)
     surf = _bem_find_surface(bem, "inner_skull")
     points = surf["rr"]
     points = apply_trans(trans["trans"], points)
@@ -381,47 +463,38 @@ def _compute_depth(dip, fname_bem, fname_trans, subject, subjects_dir):
 
 
 @testing.requires_testing_data
-def test_accuracy():
+def test_accuracy(_evoked_sample):
     """Test dipole fitting to sub-mm accuracy."""
-    evoked = read_evokeds(fname_evo)[0].crop(
+    evoked = _evoked_sample.copy().crop(
         0.0,
         0.0,
     )
     evoked.pick("meg")
     evoked.pick([c for c in evoked.ch_names[::4]])
+    evoked.info.normalize_proj()
+    # the source space is not modified by make_forward_solution, so it (and
+    # everything derived from it) can be shared by both sphere models
+    src = read_source_spaces(fname_src)
+    vertices = [src[0]["vertno"], src[1]["vertno"]]
+    n_vertices = sum(len(v) for v in vertices)
+    amp = 10e-9
+    data = np.eye(n_vertices + 1)[:n_vertices]
+    data[-1, -1] = 1.0
+    data *= amp
+    stc = SourceEstimate(data, vertices, 0.0, 1e-3, "sample")
+    cov = make_ad_hoc_cov(evoked.info)
+    src_rr = np.concatenate(
+        [src[0]["rr"][vertices[0]], src[1]["rr"][vertices[1]]], axis=0
+    )
     for rad, perc_90 in zip((0.09, None), (0.002, 0.004)):
         bem = make_sphere_model(
             "auto", rad, evoked.info, relative_radii=(0.999, 0.998, 0.997, 0.995)
         )
-        src = read_source_spaces(fname_src)
-
         fwd = make_forward_solution(evoked.info, None, src, bem)
         fwd = convert_forward_solution(fwd, force_fixed=True, use_cps=True)
-        vertices = [src[0]["vertno"], src[1]["vertno"]]
-        n_vertices = sum(len(v) for v in vertices)
-        amp = 10e-9
-        data = np.eye(n_vertices + 1)[:n_vertices]
-        data[-1, -1] = 1.0
-        data *= amp
-        stc = SourceEstimate(data, vertices, 0.0, 1e-3, "sample")
-        evoked.info.normalize_proj()
         sim = simulate_evoked(fwd, stc, evoked.info, cov=None, nave=np.inf)
-
-        cov = make_ad_hoc_cov(evoked.info)
         dip = fit_dipole(sim, cov, bem, min_dist=0.001)[0]
-
-        ds = []
-        for vi in range(n_vertices):
-            if vi < len(vertices[0]):
-                hi = 0
-                vertno = vi
-            else:
-                hi = 1
-                vertno = vi - len(vertices[0])
-            vertno = src[hi]["vertno"][vertno]
-            rr = src[hi]["rr"][vertno]
-            d = np.sqrt(np.sum((rr - dip.pos[vi]) ** 2))
-            ds.append(d)
+        ds = np.linalg.norm(src_rr - dip.pos, axis=1)
         # make sure that our median is sub-mm and the large majority are very
         # close (we expect some to be off by a bit e.g. because they are
         # radial)
@@ -453,21 +526,25 @@ def _check_roundtrip_fixed(dip, tmp_path):
     assert_allclose(dip_read.times, dip.times, atol=1e-8)
     assert dip_read.info["xplotter_layout"] == dip.info["xplotter_layout"]
     assert dip_read.ch_names == dip.ch_names
-    for ch_1, ch_2 in zip(dip_read.info["chs"], dip.info["chs"]):
-        assert ch_1["ch_name"] == ch_2["ch_name"]
-        for key in (
-            "loc",
-            "kind",
-            "unit_mul",
-            "range",
-            "coord_frame",
-            "unit",
-            "cal",
-            "coil_type",
-            "scanno",
-            "logno",
-        ):
-            assert_allclose(ch_1[key], ch_2[key], err_msg=key)
+    chs_1, chs_2 = dip_read.info["chs"], dip.info["chs"]
+    assert [ch["ch_name"] for ch in chs_1] == [ch["ch_name"] for ch in chs_2]
+    for key in (
+        "loc",
+        "kind",
+        "unit_mul",
+        "range",
+        "coord_frame",
+        "unit",
+        "cal",
+        "coil_type",
+        "scanno",
+        "logno",
+    ):
+        assert_allclose(
+            np.array([ch[key] for ch in chs_1]),
+            np.array([ch[key] for ch in chs_2]),
+            err_msg=key,
+        )
 
 
 @pytest.mark.parametrize(
@@ -488,7 +565,7 @@ def test_get_phantom_dipoles(kind, count):
     assert pos.shape == (count, 3)
     assert ori.shape == (count, 3)
     # pos should be orthogonal to ori for all dipoles
-    assert_allclose(np.sum(pos * ori, axis=1), 0.0, atol=1e-7)
+    assert_allclose(np.einsum("ij,ij->i", pos, ori), 0.0, atol=1e-7)
 
 
 @testing.requires_testing_data
@@ -510,10 +587,14 @@ def test_confidence(tmp_path):
         assert_array_equal(dip_check.nfree, dip_xfit.nfree)  # exact match
         assert_allclose(dip_check.khi2, dip_xfit.khi2, rtol=2e-2)  # 2% miss
         assert set(dip_check.conf.keys()) == set(dip_xfit.conf.keys())
-        for key in sorted(dip_check.conf.keys()):
-            assert_allclose(
-                dip_check.conf[key], dip_xfit.conf[key], rtol=1.5e-1, err_msg=key
-            )
+        keys = sorted(dip_check.conf)
+        assert_allclose(
+            np.stack([dip_check.conf[key] for key in keys]),
+            np.stack([dip_xfit.conf[key] for key in keys]),
+            rtol=1.5e-1,
+            err_msg="row -> key: "
+            + ", ".join(f"{ii} -> {key}" for ii, key in enumerate(keys)),
+        )
 
 
 # bdip created with:
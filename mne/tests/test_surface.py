@@ -7,6 +7,7 @@ from pathlib import Path
 import numpy as np
 import pytest
 from numpy.testing import assert_allclose, assert_array_equal, assert_equal
+from scipy.spatial.distance import cdist
 
 from mne import (
     decimate_surface,
@@ -122,6 +123,18 @@ def test_compute_nearest():
         assert_array_equal(nn1, nn2)
         assert_array_equal(nn1, nn3)
 
+    # automatic method with few (brute force if numba is available) and many
+    # (tree) queries, and explicit brute force, against scipy's cdist
+    for n_query in (3, 20):
+        assert (n_query <= np.log2(len(x))) == (n_query == 3)
+        y = x[nn_true[:n_query]] + 1e-3
+        d = cdist(y, x)
+        for method in ("auto", "brute"):
+            nnn4 = _compute_nearest(x, y, method=method, return_dists=True)
+            assert_array_equal(nnn4[0], nn_true[:n_query])
+            assert_array_equal(nnn4[0], d.argmin(axis=1))
+            assert_allclose(nnn4[1], d.min(axis=1))
+
 
 @testing.requires_testing_data
 def test_io_surface(tmp_path):